@@ -16,66 +16,1028 @@ The merge_backup function accepts the following arguments:
     dry_run (bool, optional): If True, only displays the log messages of what
                               would be done without actually executing the
                               operations. Default is False.
+    compress_old_versions (bool, optional): If True, older files moved to the
+                              '.oldversion' subfolder are compressed with
+                              Zstandard. Default is False.
 
 Example usage:
     merge_backup("path/to/folder_to_backup", "path/to/backup_location", verbose=True)
 
 """
 
+import contextlib
+import ctypes
+import ctypes.util
+import errno
 import filecmp
+import functools
+import hashlib
+import json
 import logging
+import logging.handlers
+import mmap
 import os
 import shutil
+import struct
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from pathlib import Path
+from stat import S_ISREG
 from tqdm import tqdm
 import sys
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
-def build_file_tree(root):
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+# Hash used for content digests. xxh3_128 from the optional xxhash package, installed
+# with the fast extra, is several times faster than BLAKE2b, which is used if xxhash
+# is not installed.
+if xxhash is not None:
+    HASH_NAME = "xxh3_128"
+    _new_hasher = xxhash.xxh3_128
+else:
+    HASH_NAME = "blake2b"
+    _new_hasher = functools.partial(hashlib.blake2b, digest_size=16)
+
+# Read size used when hashing file contents
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files larger than this are compared through memory maps instead of buffered reads
+MMAP_COMPARE_THRESHOLD = 256 * 1024
+
+# Number of bytes compared at the start and end of files before comparing their full content
+QUICK_COMPARE_SIZE = 4096
+
+# Number of log records buffered in memory before they are written to the log file
+LOG_BUFFER_SIZE = 1024
+
+# Number of threads used to scan directories in parallel
+SCAN_WORKERS = 16
+
+# Number of threads comparing file contents in parallel
+COMPARE_WORKERS = (os.cpu_count() or 1) * 2
+
+# Name of the index of sizes and content digests kept in each .oldversion folder,
+# and the names of the index and of its temporary file while it is written
+OLD_VERSIONS_INDEX = ".index.json"
+OLD_VERSIONS_INDEX_FILES = frozenset({OLD_VERSIONS_INDEX, OLD_VERSIONS_INDEX + ".tmp"})
+
+# Suffix and Zstandard compression level of old versions stored compressed
+OLD_VERSION_COMPRESSED_SUFFIX = ".zst"
+ZSTD_LEVEL = 3
+
+# Name of the manifest of content digests kept in the backup location between runs,
+# and the names of the manifest and of its temporary file while it is written
+MERGE_MANIFEST = ".merge_manifest.json"
+MERGE_MANIFEST_FILES = frozenset({MERGE_MANIFEST, MERGE_MANIFEST + ".tmp"})
+
+# Name of the log file that merges append to in the backup location
+MERGE_LOG = "backup_merger.log"
+
+# getattrlistbulk(2) constants from <sys/attr.h> and <sys/vnode.h>
+ATTR_BIT_MAP_COUNT = 5
+ATTR_CMN_NAME = 0x00000001
+ATTR_CMN_OBJTYPE = 0x00000008
+ATTR_CMN_MODTIME = 0x00000400
+ATTR_CMN_RETURNED_ATTRS = 0x80000000
+ATTR_FILE_DATALENGTH = 0x00000200
+VREG = 1
+VDIR = 2
+VLNK = 5
+
+# Size of the buffer each getattrlistbulk call fills with directory entries
+GETATTRLISTBULK_BUFFER_SIZE = 256 * 1024
+
+
+class _AttrList(ctypes.Structure):
+    """The attrlist structure selecting the attributes returned by getattrlistbulk."""
+
+    _fields_ = [
+        ("bitmapcount", ctypes.c_ushort),
+        ("reserved", ctypes.c_uint16),
+        ("commonattr", ctypes.c_uint32),
+        ("volattr", ctypes.c_uint32),
+        ("dirattr", ctypes.c_uint32),
+        ("fileattr", ctypes.c_uint32),
+        ("forkattr", ctypes.c_uint32),
+    ]
+
+
+def _load_getattrlistbulk():
+    """
+    Load getattrlistbulk from the C library on macOS.
+
+    :return: The getattrlistbulk function, or None if it is not available
+    """
+    if sys.platform != "darwin":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        getattrlistbulk = libc.getattrlistbulk
+    except (OSError, AttributeError):
+        return None
+    getattrlistbulk.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_uint64,
+    ]
+    getattrlistbulk.restype = ctypes.c_int
+    return getattrlistbulk
+
+
+_getattrlistbulk = _load_getattrlistbulk()
+
+
+def _parse_attr_buffer(buffer, count):
+    """
+    Parse the entries packed into a buffer by getattrlistbulk.
+
+    Each entry starts with its length and the set of returned attributes, followed
+    by the name, object type, modification time and, for regular files, the data
+    length, each present only if it was returned.
+
+    :param buffer: Buffer filled by getattrlistbulk
+    :param count: Number of entries in the buffer
+    :return: List of (name, object type, modification time, size) tuples
+    """
+    entries = []
+    offset = 0
+
+    for _ in range(count):
+        (length,) = struct.unpack_from("=I", buffer, offset)
+        commonattr, _, _, fileattr, _ = struct.unpack_from("=5I", buffer, offset + 4)
+        pos = offset + 24
+
+        name = objtype = mtime = size = None
+        if commonattr & ATTR_CMN_NAME:
+            # The name is referenced relative to the attrreference itself, and its
+            # length includes the terminating NUL
+            name_offset, name_length = struct.unpack_from("=iI", buffer, pos)
+            name_start = pos + name_offset
+            name = os.fsdecode(bytes(buffer[name_start : name_start + name_length - 1]))
+            pos += 8
+        if commonattr & ATTR_CMN_OBJTYPE:
+            (objtype,) = struct.unpack_from("=I", buffer, pos)
+            pos += 4
+        if commonattr & ATTR_CMN_MODTIME:
+            tv_sec, tv_nsec = struct.unpack_from("=qq", buffer, pos)
+            # Same conversion as os.stat uses for st_mtime
+            mtime = tv_sec + tv_nsec * 1e-9
+            pos += 16
+        if fileattr & ATTR_FILE_DATALENGTH:
+            (size,) = struct.unpack_from("=q", buffer, pos)
+
+        entries.append((name, objtype, mtime, size))
+        offset += length
+
+    return entries
+
+
+def _excluded_names(rel_dir):
+    """
+    Get the names of the files that merge_backup keeps for itself in a directory,
+    which are left out of file trees so that they are never merged as user files.
+
+    :param rel_dir: Path of the directory relative to the root of the tree
+    :return: Set of the excluded file names
+    """
+    if not rel_dir:
+        return MERGE_MANIFEST_FILES | {MERGE_LOG}
+    if os.path.basename(rel_dir) == ".oldversion":
+        return OLD_VERSIONS_INDEX_FILES
+    return frozenset()
+
+
+def _scan_dir_bulk(dir_path, rel_dir):
+    """
+    Scan a single directory with getattrlistbulk, which returns the names, types,
+    modification times and sizes of many entries per system call instead of
+    requiring a stat call per file.
+
+    :param dir_path: Path to the directory
+    :param rel_dir: Path of the directory relative to the root of the tree
+    :return: Same as _scan_dir
     """
-    Build a file tree dictionary with relative paths as keys and modification times as values.
+    files = {}
+    subdirs = []
+    # Relative paths of the entries are built by appending their names to this prefix
+    rel_prefix = os.path.join(rel_dir, "") if rel_dir else ""
+    excluded_names = _excluded_names(rel_dir)
+
+    attr_list = _AttrList(
+        bitmapcount=ATTR_BIT_MAP_COUNT,
+        commonattr=ATTR_CMN_RETURNED_ATTRS | ATTR_CMN_NAME | ATTR_CMN_OBJTYPE | ATTR_CMN_MODTIME,
+        fileattr=ATTR_FILE_DATALENGTH,
+    )
+    buffer = ctypes.create_string_buffer(GETATTRLISTBULK_BUFFER_SIZE)
+
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        while True:
+            count = _getattrlistbulk(fd, ctypes.byref(attr_list), buffer, len(buffer), 0)
+            if count < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), dir_path)
+            if count == 0:
+                break
+
+            for name, objtype, mtime, size in _parse_attr_buffer(buffer, count):
+                if name is None or name in excluded_names:
+                    continue
+                path = os.path.join(dir_path, name)
+                rel_path = rel_prefix + name
+                if objtype == VREG and mtime is not None and size is not None:
+                    files[rel_path] = (mtime, size)
+                elif objtype == VDIR:
+                    subdirs.append((path, rel_path))
+                elif objtype == VLNK:
+                    # Symbolic links to files are followed, as they are by os.scandir
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if S_ISREG(stat.st_mode):
+                        files[rel_path] = (stat.st_mtime, stat.st_size)
+    finally:
+        os.close(fd)
+
+    return files, subdirs
+
+
+def _scan_dir(dir_path, rel_dir):
+    """
+    Scan a single directory.
+
+    :param dir_path: Path to the directory
+    :param rel_dir: Path of the directory relative to the root of the tree
+    :return: Tuple of a dictionary mapping relative file paths to (modification time, size)
+             tuples, and a list of (path, relative path) tuples of the subdirectories
+    """
+    if _getattrlistbulk is not None:
+        return _scan_dir_bulk(dir_path, rel_dir)
+
+    files = {}
+    subdirs = []
+    # Relative paths of the entries are built by appending their names to this prefix
+    rel_prefix = os.path.join(rel_dir, "") if rel_dir else ""
+    excluded_names = _excluded_names(rel_dir)
+
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name in excluded_names:
+                continue
+            rel_path = rel_prefix + entry.name
+            if entry.is_file():
+                # Store the file's modification time and size
+                stat = entry.stat()
+                files[rel_path] = (stat.st_mtime, stat.st_size)
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, rel_path))
+
+    return files, subdirs
+
+
+def build_file_tree(root, max_workers=SCAN_WORKERS):
+    """
+    Build a file tree dictionary with relative paths as keys and (modification time, size)
+    tuples as values.
+
+    Directories are scanned in parallel by a pool of threads, which overlaps the
+    latency of directory listings on slow or network file systems.
 
     :param root: Path to the root directory
-    :return: Dictionary containing the file tree with relative paths and their modification times
+    :param max_workers: Number of threads scanning directories
+    :return: Dictionary containing the file tree with relative paths and their
+             modification times and sizes
     """
     file_tree = {}
 
-    for entry in os.scandir(root):
-        if entry.is_file():
-            # Calculate the relative path and store the file's modification time
-            rel_path = os.path.relpath(entry.path, root)
-            file_tree[rel_path] = entry.stat().st_mtime
-        elif entry.is_dir():
-            # Recursively build the file tree for the subdirectory
-            subdir_tree = build_file_tree(entry.path)
-            # Merge the subdirectory tree with the main file tree
-            for subpath, mtime in subdir_tree.items():
-                file_tree[os.path.join(entry.name, subpath)] = mtime
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_scan_dir, root, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                file_tree.update(files)
+                # Queue the subdirectories for the next free worker
+                for dir_path, rel_dir in subdirs:
+                    pending.add(executor.submit(_scan_dir, dir_path, rel_dir))
 
     return file_tree
 
 
-def is_unique_version(file_path, old_versions_dir):
+def file_digest(file_path, mtime=None, size=None, digest_cache=None):
+    """
+    Compute the digest of a file's content, reusing a cached digest if the
+    file has already been hashed with the same modification time and size.
+
+    The cache is meant to live for a single merge: a file replaced at the same
+    path with the same modification time and size would otherwise be given the
+    digest of the file it replaced.
+
+    Args:
+        file_path (str): The path of the file to hash.
+        mtime (float, optional): The modification time of the file. Looked up with
+                                 os.stat if not given.
+        size (int, optional): The size of the file in bytes. Looked up with os.stat
+                              if not given.
+        digest_cache (dict, optional): Dictionary of digests keyed by (path, mtime,
+                                       size), used and updated if given. Default is
+                                       None, which always hashes the file.
+
+    Returns:
+        str: The hex digest of the file's content.
+    """
+    if mtime is None or size is None:
+        stat = os.stat(file_path)
+        mtime, size = stat.st_mtime, stat.st_size
+
+    key = (file_path, mtime, size)
+    digest = digest_cache.get(key) if digest_cache is not None else None
+    if digest is None:
+        hasher = _new_hasher()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        if digest_cache is not None:
+            digest_cache[key] = digest
+    return digest
+
+
+def quick_differ(file_path1, file_path2, size):
+    """
+    Check if two files of the same size differ in their first or last few kilobytes.
+
+    Most files that differ can be told apart this way without reading them in full.
+
+    Args:
+        file_path1 (str): The path of the first file.
+        file_path2 (str): The path of the second file.
+        size (int): The size of both files in bytes.
+
+    Returns:
+        bool: True if the files are known to differ, False if their full content
+              has to be compared to tell.
+    """
+    with open(file_path1, "rb") as f1, open(file_path2, "rb") as f2:
+        if f1.read(QUICK_COMPARE_SIZE) != f2.read(QUICK_COMPARE_SIZE):
+            return True
+        if size > QUICK_COMPARE_SIZE:
+            tail_offset = max(QUICK_COMPARE_SIZE, size - QUICK_COMPARE_SIZE)
+            f1.seek(tail_offset)
+            f2.seek(tail_offset)
+            if f1.read(QUICK_COMPARE_SIZE) != f2.read(QUICK_COMPARE_SIZE):
+                return True
+    return False
+
+
+def fast_cmp(file_path1, file_path2, size1=None, size2=None):
+    """
+    Compare the contents of two files.
+
+    Files of different sizes are reported as different without being read. Large
+    files are memory-mapped and compared a chunk at a time, which avoids the many
+    small reads of filecmp.cmp.
+
+    Args:
+        file_path1 (str): The path of the first file.
+        file_path2 (str): The path of the second file.
+        size1 (int, optional): The size of the first file. Looked up if not given.
+        size2 (int, optional): The size of the second file. Looked up if not given.
+
+    Returns:
+        bool: True if the files have the same content, False otherwise.
+    """
+    if size1 is None:
+        size1 = os.path.getsize(file_path1)
+    if size2 is None:
+        size2 = os.path.getsize(file_path2)
+
+    if size1 != size2:
+        return False
+    if size1 == 0:
+        return True
+    if size1 <= MMAP_COMPARE_THRESHOLD:
+        return filecmp.cmp(file_path1, file_path2, shallow=False)
+
+    with open(file_path1, "rb") as f1, open(file_path2, "rb") as f2:
+        with mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as map1, mmap.mmap(
+            f2.fileno(), 0, access=mmap.ACCESS_READ
+        ) as map2:
+            for offset in range(0, size1, HASH_CHUNK_SIZE):
+                end = offset + HASH_CHUNK_SIZE
+                if map1[offset:end] != map2[offset:end]:
+                    return False
+    return True
+
+
+def files_identical(file_path1, file_path2, file_info1, file_info2, digest_cache=None):
+    """
+    Check if two files have the same content, reading as little as possible.
+
+    Files of different sizes cannot be identical, and most files that differ
+    already do in their first or last block, so the files are only hashed if both
+    of these checks pass.
+
+    Args:
+        file_path1 (str): The path of the first file.
+        file_path2 (str): The path of the second file.
+        file_info1 (tuple): The (modification time, size) of the first file.
+        file_info2 (tuple): The (modification time, size) of the second file.
+        digest_cache (dict, optional): Passed on to file_digest. Default is None.
+
+    Returns:
+        bool: True if the files have the same content, False otherwise.
+    """
+    mtime1, size1 = file_info1
+    mtime2, size2 = file_info2
+    return (
+        size1 == size2
+        and not quick_differ(file_path1, file_path2, size1)
+        and file_digest(file_path1, mtime1, size1, digest_cache)
+        == file_digest(file_path2, mtime2, size2, digest_cache)
+    )
+
+
+def _copy_file_range(source_path, dest_path):
+    """
+    Copy the content of a file with os.copy_file_range, which copies the data inside
+    the kernel without passing it through user space.
+
+    :param source_path: Path to the file to copy
+    :param dest_path: Path to copy the file to
+    :raises OSError: If the file system does not support copy_file_range between the
+                     two files, or stops copying before the end of the file
+    """
+    with open(source_path, "rb") as f_in, open(dest_path, "wb") as f_out:
+        remaining = os.fstat(f_in.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), remaining)
+            if copied == 0:
+                raise OSError(
+                    errno.EIO, "copy_file_range stopped before the end of the file", source_path
+                )
+            remaining -= copied
+
+
+def fast_copy(source_path, dest_path):
+    """
+    Copy a file together with its modification time and permissions.
+
+    The content is copied with copy_file_range where available, and with
+    shutil.copyfile otherwise or if copy_file_range fails, which already uses
+    sendfile on Linux and fcopyfile on macOS.
+
+    Args:
+        source_path (str): The path of the file to copy.
+        dest_path (str): The path to copy the file to.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            _copy_file_range(source_path, dest_path)
+        except OSError:
+            shutil.copyfile(source_path, dest_path)
+    else:
+        shutil.copyfile(source_path, dest_path)
+    shutil.copystat(source_path, dest_path)
+
+
+def move_file(source_path, dest_path, same_device=True):
+    """
+    Move a file, renaming it in place if both paths are on the same file system, and
+    copying it with fast_copy before removing it otherwise. The file is only removed
+    once the copy has the same size as the file.
+
+    Args:
+        source_path (str): The path of the file to move.
+        dest_path (str): The path to move the file to.
+        same_device (bool, optional): If True, the paths are expected to be on the
+                                      same file system and the file is renamed
+                                      directly, falling back to copying it if the
+                                      rename fails. Default is True.
+
+    Raises:
+        OSError: If the copy does not have the same size as the file, in which case
+                 the file is kept.
+    """
+    if same_device:
+        try:
+            os.rename(source_path, dest_path)
+            return
+        except OSError:
+            pass
+    source_size = os.stat(source_path).st_size
+    fast_copy(source_path, dest_path)
+    dest_size = os.stat(dest_path).st_size
+    if dest_size != source_size:
+        raise OSError(
+            errno.EIO,
+            f"Copied {dest_size} of {source_size} bytes, keeping the original file",
+            source_path,
+        )
+    os.remove(source_path)
+
+
+def _fmt_ts(mtime):
+    """
+    Format a modification time as the local-time timestamp used in old version names,
+    in the same format as strftime("%Y%m%d_%H%M%S") without creating a datetime.
+
+    :param mtime: Modification time in seconds since the epoch
+    :return: Timestamp string
+    """
+    t = time.localtime(mtime)
+    return "%04d%02d%02d_%02d%02d%02d" % (
+        t.tm_year,
+        t.tm_mon,
+        t.tm_mday,
+        t.tm_hour,
+        t.tm_min,
+        t.tm_sec,
+    )
+
+
+def _read_digest_file(path, keep_other_hash=False):
+    """
+    Read the file records saved in a digest index or manifest.
+
+    :param path: Path to the JSON file
+    :param keep_other_hash: Boolean, keep the records of a file whose digests were computed
+                            with a different hash, with their digests set to None, if True
+    :return: Dictionary of the file records, empty if the file cannot be read or its
+             digests were computed with a different hash and keep_other_hash is False
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or not isinstance(data.get("files"), dict):
+        return {}
+    if data.get("hash") == HASH_NAME:
+        return data["files"]
+    if not keep_other_hash:
+        return {}
+    return {
+        name: dict(record, digest=None)
+        for name, record in data["files"].items()
+        if isinstance(record, dict)
+    }
+
+
+def _write_digest_file(path, files):
+    """
+    Write file records to a digest index or manifest, together with the name of the
+    hash used for their digests. The file is replaced only once it is fully written
+    so that an interrupted write does not leave a truncated file behind.
+
+    :param path: Path to the JSON file
+    :param files: Dictionary of the file records
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"hash": HASH_NAME, "files": files}, f)
+    os.replace(temp_path, path)
+
+
+def load_old_versions_index(old_versions_dir):
+    """
+    Load the index of a .oldversion folder and bring it up to date with the files
+    actually in the folder.
+
+    The index maps the file names of the old versions to dictionaries with their
+    modification time, size and content digest. Files that are missing from the
+    index, or whose modification time or size changed, get a digest of None and
+    are hashed only when needed, as do all files if the index was saved with a
+    different hash. Old versions stored compressed are recognized by their suffix,
+    and the size of their content is found when they are hashed.
+
+    Args:
+        old_versions_dir (str): The path of the .oldversion folder.
+
+    Returns:
+        dict: The index of the old versions, empty if the folder does not exist.
+    """
+    saved_index = _read_digest_file(
+        os.path.join(old_versions_dir, OLD_VERSIONS_INDEX), keep_other_hash=True
+    )
+
+    index = {}
+    try:
+        with os.scandir(old_versions_dir) as entries:
+            for entry in entries:
+                if entry.name in OLD_VERSIONS_INDEX_FILES or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                record = saved_index.get(entry.name)
+                if (
+                    not isinstance(record, dict)
+                    or record.get("mtime") != stat.st_mtime
+                    or record.get("size") != stat.st_size
+                    or "digest" not in record
+                ):
+                    record = {"mtime": stat.st_mtime, "size": stat.st_size, "digest": None}
+                    if entry.name.endswith(OLD_VERSION_COMPRESSED_SUFFIX):
+                        record["compressed"] = True
+                index[entry.name] = record
+    except FileNotFoundError:
+        pass
+
+    return index
+
+
+def save_old_versions_index(old_versions_dir, index):
+    """
+    Save the index of a .oldversion folder.
+
+    Args:
+        old_versions_dir (str): The path of the .oldversion folder.
+        index (dict): The index of the old versions, as returned by load_old_versions_index.
+    """
+    _write_digest_file(os.path.join(old_versions_dir, OLD_VERSIONS_INDEX), index)
+
+
+def _cached_old_versions_index(old_versions_dir, index_cache=None):
+    """
+    Get the index of a .oldversion folder from a cache, loading it the first time.
+
+    :param old_versions_dir: Path to the .oldversion folder
+    :param index_cache: Dictionary mapping .oldversion folders to their indexes, or
+                        None to always load the index
+    :return: The index of the old versions
+    """
+    if index_cache is None:
+        return load_old_versions_index(old_versions_dir)
+
+    index = index_cache.get(old_versions_dir)
+    if index is None:
+        index = index_cache[old_versions_dir] = load_old_versions_index(old_versions_dir)
+    return index
+
+
+def add_old_version(
+    old_versions_dir,
+    old_version_filename,
+    mtime,
+    size,
+    digest=None,
+    content_size=None,
+    index_cache=None,
+):
+    """
+    Record a file that was moved into a .oldversion folder in the folder's index.
+
+    Args:
+        old_versions_dir (str): The path of the .oldversion folder.
+        old_version_filename (str): The file name of the old version.
+        mtime (float): The modification time of the old version.
+        size (int): The size of the old version in bytes.
+        digest (str, optional): The content digest of the old version, if known.
+        content_size (int, optional): The size of the content of the old version if
+                                      it is stored compressed. Default is None, for
+                                      old versions stored as is.
+        index_cache (dict, optional): Dictionary mapping .oldversion folders to their
+                                      indexes. If given, the index is updated in the
+                                      cache and the caller is responsible for saving
+                                      it. Default is None, which loads and saves the
+                                      index.
+    """
+    record = {"mtime": mtime, "size": size, "digest": digest}
+    if content_size is not None:
+        record["compressed"] = True
+        record["content_size"] = content_size
+
+    index = _cached_old_versions_index(old_versions_dir, index_cache)
+    index[old_version_filename] = record
+    if index_cache is None:
+        save_old_versions_index(old_versions_dir, index)
+
+
+def compress_old_version(file_path, old_version_path):
+    """
+    Compress a file with Zstandard into a .oldversion folder and remove the original.
+    The compressed file keeps the modification time of the original.
+
+    Args:
+        file_path (str): The path of the file to compress.
+        old_version_path (str): The path of the compressed old version.
+
+    Returns:
+        str: The content digest of the file, computed while compressing it.
+    """
+    hasher = _new_hasher()
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    with open(file_path, "rb") as f_in, open(old_version_path, "wb") as f_out:
+        with compressor.stream_writer(f_out, closefd=False) as writer:
+            for chunk in iter(lambda: f_in.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                writer.write(chunk)
+    shutil.copystat(file_path, old_version_path)
+    os.remove(file_path)
+    return hasher.hexdigest()
+
+
+def decompress_old_version(old_version_path, file_path):
+    """
+    Restore an old version stored compressed with Zstandard. The restored file keeps
+    the modification time of the compressed old version.
+
+    Args:
+        old_version_path (str): The path of the compressed old version.
+        file_path (str): The path to restore the old version to.
+    """
+    decompressor = zstandard.ZstdDecompressor()
+    with open(old_version_path, "rb") as f_in, open(file_path, "wb") as f_out:
+        decompressor.copy_stream(f_in, f_out)
+    shutil.copystat(old_version_path, file_path)
+
+
+def _compressed_digest(old_version_path):
+    """
+    Compute the content digest and content size of an old version stored compressed,
+    which is decompressed as it is read.
+
+    :param old_version_path: Path to the compressed old version
+    :return: Tuple of the hex digest and the size of the content in bytes
+    """
+    hasher = _new_hasher()
+    content_size = 0
+    decompressor = zstandard.ZstdDecompressor()
+    with open(old_version_path, "rb") as f:
+        with decompressor.stream_reader(f) as reader:
+            for chunk in iter(lambda: reader.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                content_size += len(chunk)
+    return hasher.hexdigest(), content_size
+
+
+def _compressed_cmp(file_path, old_version_path):
+    """
+    Compare the contents of a file and of an old version stored compressed, which is
+    decompressed as it is read.
+
+    :param file_path: Path to the file
+    :param old_version_path: Path to the compressed old version
+    :return: True if the file has the same content as the old version, False otherwise
+    """
+    decompressor = zstandard.ZstdDecompressor()
+    with open(file_path, "rb") as f, open(old_version_path, "rb") as f_old:
+        with decompressor.stream_reader(f_old) as reader:
+            while True:
+                old_chunk = reader.read(HASH_CHUNK_SIZE)
+                if not old_chunk:
+                    return not f.read(1)
+                if f.read(len(old_chunk)) != old_chunk:
+                    return False
+
+
+def store_old_version(
+    file_path,
+    file_info,
+    old_version_path,
+    compress=False,
+    same_device=True,
+    index_cache=None,
+    digest_cache=None,
+):
+    """
+    Move a file into a .oldversion folder and record it in the folder's index.
+
+    Args:
+        file_path (str): The path of the file.
+        file_info (tuple): The (modification time, size) of the file.
+        old_version_path (str): The path of the old version.
+        compress (bool, optional): If True, the old version is stored compressed with
+                                   Zstandard instead of being moved. Default is False.
+        same_device (bool, optional): Passed on to move_file. Default is True.
+        index_cache (dict, optional): Passed on to add_old_version. Default is None.
+        digest_cache (dict, optional): Digests computed during the merge, used to record
+                                       the digest of the old version if it is known.
+                                       Default is None.
+    """
+    mtime, size = file_info
+    old_versions_dir, old_version_filename = os.path.split(old_version_path)
+
+    if compress:
+        digest = compress_old_version(file_path, old_version_path)
+        add_old_version(
+            old_versions_dir,
+            old_version_filename,
+            mtime,
+            os.path.getsize(old_version_path),
+            digest,
+            content_size=size,
+            index_cache=index_cache,
+        )
+    else:
+        digest = digest_cache.get((file_path, mtime, size)) if digest_cache is not None else None
+        move_file(file_path, old_version_path, same_device)
+        add_old_version(
+            old_versions_dir, old_version_filename, mtime, size, digest, index_cache=index_cache
+        )
+
+
+def load_merge_manifest(backup_location, digest_cache=None):
+    """
+    Load the manifest saved in the backup location by the previous merge and add
+    its digests to a digest cache.
+
+    Digests are cached by modification time and size, so a digest is only reused
+    for files that have not changed since the manifest was saved.
+
+    Args:
+        backup_location (str): The path of the backup location.
+        digest_cache (dict, optional): Dictionary of digests keyed by (path, mtime,
+                                       size) to add the manifest's digests to.
+                                       Default is None.
+
+    Returns:
+        dict: The manifest mapping relative file paths to dictionaries with their
+              modification time, size and content digest, empty if there is none.
+    """
+    manifest = _read_digest_file(os.path.join(backup_location, MERGE_MANIFEST))
+
+    if digest_cache is None:
+        return manifest
+
+    backup_prefix = os.path.join(backup_location, "")
+    for rel_path, record in manifest.items():
+        try:
+            key = (backup_prefix + rel_path, record["mtime"], record["size"])
+            digest_cache[key] = record["digest"]
+        except (KeyError, TypeError):
+            continue
+    return manifest
+
+
+def save_merge_manifest(backup_location, file_trees, digest_cache):
+    """
+    Save the digests of the files in the backup location that are known after a
+    merge, so that the next merge does not have to read them again.
+
+    Args:
+        backup_location (str): The path of the backup location.
+        file_trees (list): List of (root, file tree) tuples of the folders whose files
+                           are now in the backup location at the same relative path.
+                           Only files that are actually in the backup location may be
+                           listed, and later trees take precedence over earlier ones.
+                           A digest is only saved if the file in the backup location
+                           still has the modification time and size it was hashed with.
+        digest_cache (dict): Dictionary of the digests computed during the merge, keyed
+                             by (path, mtime, size).
+    """
+    manifest = {}
+    backup_prefix = os.path.join(backup_location, "")
+    for root, file_tree in file_trees:
+        root_prefix = os.path.join(root, "")
+        for rel_path, (mtime, size) in file_tree.items():
+            digest = digest_cache.get((root_prefix + rel_path, mtime, size))
+            if digest is None:
+                continue
+            try:
+                stat = os.stat(backup_prefix + rel_path)
+            except OSError:
+                continue
+            if stat.st_mtime == mtime and stat.st_size == size:
+                manifest[rel_path] = {"mtime": mtime, "size": size, "digest": digest}
+
+    _write_digest_file(os.path.join(backup_location, MERGE_MANIFEST), manifest)
+
+
+def is_unique_version(
+    file_path, old_versions_dir, update_index=True, index_cache=None, digest_cache=None
+):
     """
     Check if a file is unique compared to all other versions in the .oldversion folder.
 
+    The file is looked up by size and content digest in the folder's index, so only
+    old versions whose digests are not indexed yet are read. A digest match is
+    confirmed by comparing the two files byte by byte, decompressing old versions
+    that are stored compressed.
+
     Args:
         file_path (str): The path of the file to compare.
         old_versions_dir (str): The path of the .oldversion folder.
+        update_index (bool, optional): If True, digests computed during the check are
+                                       saved to the folder's index. Default is True.
+        index_cache (dict, optional): Dictionary mapping .oldversion folders to their
+                                      indexes, so that each folder is only listed once
+                                      when checking many files. If given, computed
+                                      digests are kept in the cache and the caller is
+                                      responsible for saving the index. Default is None.
+        digest_cache (dict, optional): Passed on to file_digest. Default is None, which
+                                       only caches digests during this check.
 
     Returns:
         bool: True if the file is unique, False if it's identical to any of the existing versions.
     """
-    for old_version_file in os.listdir(old_versions_dir):
+    if digest_cache is None:
+        digest_cache = {}
+
+    stat = os.stat(file_path)
+    index = _cached_old_versions_index(old_versions_dir, index_cache)
+    digest = None
+    index_changed = False
+    unique = True
+
+    for old_version_file, record in index.items():
         old_version_path = os.path.join(old_versions_dir, old_version_file)
-        if filecmp.cmp(file_path, old_version_path, shallow=False):
-            return False
-    return True
+        if record.get("compressed"):
+            if zstandard is None:
+                # Old versions stored compressed cannot be read without zstandard
+                continue
+            if record["digest"] is None or record.get("content_size") is None:
+                # The digest of a compressed old version is the digest of its content
+                record["digest"], record["content_size"] = _compressed_digest(old_version_path)
+                index_changed = True
+            if record["content_size"] != stat.st_size:
+                continue
+        elif record["size"] != stat.st_size:
+            continue
+        if digest is None:
+            digest = file_digest(file_path, stat.st_mtime, stat.st_size, digest_cache)
+        if record["digest"] is None:
+            record["digest"] = file_digest(
+                old_version_path, record["mtime"], record["size"], digest_cache
+            )
+            index_changed = True
+        if record["digest"] != digest:
+            continue
+        if record.get("compressed"):
+            identical = _compressed_cmp(file_path, old_version_path)
+        else:
+            identical = fast_cmp(file_path, old_version_path, stat.st_size, record["size"])
+        if identical:
+            unique = False
+            break
+
+    if update_index and index_changed and index_cache is None:
+        save_old_versions_index(old_versions_dir, index)
+    return unique
 
 
-def merge_backup(folder_to_backup, backup_location, verbose=False, dry_run=False):
+@contextlib.contextmanager
+def _merge_logging(log_file_path, verbose):
+    """
+    Configure the module logger for the duration of a merge.
+
+    Records are appended to the log file through a memory buffer, which writes them
+    in batches of LOG_BUFFER_SIZE records, and right away for errors. In verbose
+    mode, records are also displayed on the console without buffering.
+
+    :param log_file_path: Path to the log file
+    :param verbose: Boolean, log INFO messages and display them on the console if True
+    """
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+    file_handler = logging.FileHandler(log_file_path, mode="a")
+    file_handler.setFormatter(formatter)
+    handlers = [
+        logging.handlers.MemoryHandler(
+            LOG_BUFFER_SIZE, flushLevel=logging.ERROR, target=file_handler
+        )
+    ]
+    if verbose:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+
+    previous_level = logger.level
+    logger.setLevel(logging.INFO if verbose else logging.WARNING)
+    for handler in handlers:
+        logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        # Closing the memory handler writes the remaining buffered records
+        for handler in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+        file_handler.close()
+        logger.setLevel(previous_level)
+
+
+def merge_backup(
+    folder_to_backup,
+    backup_location,
+    verbose=False,
+    dry_run=False,
+    compress_old_versions=False,
+):
     """
     Merge the contents of a folder to a backup location, resolving conflicts by
     keeping the newest file and moving the older version to a .oldversion
@@ -91,62 +1053,137 @@ def merge_backup(folder_to_backup, backup_location, verbose=False, dry_run=False
         dry_run (bool, optional): If True, only displays the log messages of what
                                   would be done without actually executing the
                                   operations. Default is False.
+        compress_old_versions (bool, optional): If True, files moved to a .oldversion
+                                                subfolder are compressed with Zstandard,
+                                                which requires the zstandard package.
+                                                Default is False.
     """
+    if compress_old_versions and zstandard is None:
+        raise ValueError(
+            "Compressing old versions requires the zstandard package, "
+            "installed with the compress extra."
+        )
+
     start_time = time.process_time_ns()
 
-    # Configure logging settings
-    log_file_path = os.path.join(backup_location, "backup_merger.log")
-    log_format = "%(asctime)s - %(levelname)s - %(message)s"
-    log_level = logging.INFO if verbose else logging.WARNING
+    # Log to a file in the backup location, and to the console if verbose
+    log_file_path = os.path.join(backup_location, MERGE_LOG)
+    with _merge_logging(log_file_path, verbose):
+        logger.info("------------------------------------------------------------")
+        logger.info("Starting backup merge from %s to %s", folder_to_backup, backup_location)
+        logger.info("------------------------------------------------------------")
 
-    logging.basicConfig(filename=log_file_path, level=log_level, format=log_format, filemode="w")
-    logging.info("------------------------------------------------------------")
-    logging.info(f"Starting backup merge from {folder_to_backup} to {backup_location}")
-    logging.info("------------------------------------------------------------")
+        # Initialize count variables
+        count_newer = 0
+        count_different = 0
+        count_deleted = 0
+        count_moved = 0
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(log_level)
-    console_handler.setFormatter(logging.Formatter(log_format))
+        # Digests computed during this merge, keyed by (path, mtime, size). The
+        # cache starts with the digests of the files in the backup location that
+        # have not changed since the previous merge.
+        digest_cache = {}
+        load_merge_manifest(backup_location, digest_cache)
 
-    if verbose:
-        logging.getLogger().addHandler(console_handler)
-
-    # Initialize count variables
-    count_newer = 0
-    count_different = 0
-    count_deleted = 0
-    count_moved = 0
-
-    # Build the file trees for both folder_to_backup and backup_location
-    # This creates a dictionary with relative file paths as keys and
-    # their modification times as values
-    folder_to_backup_tree = build_file_tree(folder_to_backup)
-    backup_location_tree = build_file_tree(backup_location)
-
-    # Iterate through the source file tree
-    with tqdm(
-        total=len(folder_to_backup_tree.items()),
-        file=sys.stderr,
-        unit="file",
-        desc="Processing files",
-        disable=not verbose,
-    ) as pbar:
-        for rel_path, source_mtime in folder_to_backup_tree.items():
-            # for rel_path, source_mtime in folder_to_backup_tree.items():
-            # Construct the absolute file paths for the source and destination files
-            source_file_path = os.path.join(folder_to_backup, rel_path)
-            dest_file_path = os.path.join(backup_location, rel_path)
-
-            # Check if the file exists in the destination file tree
-            if rel_path in backup_location_tree:
-                logging.info(f"Found file {rel_path} in backup location")
-                # Get the modification time of the destination file
-                dest_mtime = backup_location_tree[rel_path]
-
-                # Compare the content of the source and destination files.
-                # If the content is the same, delete the source file.
-                if filecmp.cmp(source_file_path, dest_file_path, shallow=False):
-                    logging.info(f" SAME, deleting {source_file_path}")
+        # Build the file trees for both folder_to_backup and backup_location
+        # This creates a dictionary with relative file paths as keys and
+        # their modification times and sizes as values. The two trees are
+        # independent, so they are scanned at the same time.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            folder_to_backup_future = executor.submit(build_file_tree, folder_to_backup)
+            backup_location_future = executor.submit(build_file_tree, backup_location)
+            folder_to_backup_tree = folder_to_backup_future.result()
+            backup_location_tree = backup_location_future.result()
+
+        # Files moved from the folder to be backed up can be renamed instead of
+        # copied if both folders are on the same file system
+        same_device = os.stat(folder_to_backup).st_dev == os.stat(backup_location).st_dev
+
+        # Folders created during the merge, so that each one is created only once
+        created_dirs = set()
+
+        # Indexes of the .oldversion folders, so that each one is loaded only
+        # once and saved at the end of the merge
+        old_versions_indexes = {}
+
+        # Files moved from the folder to be backed up to the backup location
+        moved_paths = []
+
+        # Split the source files into those that only exist in the folder to be
+        # backed up and those that also exist in the backup location. The set
+        # operations run on the dictionary keys directly, and sorting the paths
+        # groups the files of each folder together.
+        new_paths = sorted(folder_to_backup_tree.keys() - backup_location_tree.keys())
+        common_paths = sorted(folder_to_backup_tree.keys() & backup_location_tree.keys())
+
+        # Absolute paths are built by appending relative paths to the folder paths
+        # with a trailing separator, which is cheaper than calling os.path.join for
+        # every file and gives the same paths
+        source_prefix = os.path.join(folder_to_backup, "")
+        dest_prefix = os.path.join(backup_location, "")
+
+        # Compare the files found in both locations up front. Reading and hashing
+        # is independent for every file, so the files are compared in parallel.
+        def compare_common_file(rel_path):
+            return files_identical(
+                source_prefix + rel_path,
+                dest_prefix + rel_path,
+                folder_to_backup_tree[rel_path],
+                backup_location_tree[rel_path],
+                digest_cache,
+            )
+
+        with ThreadPoolExecutor(max_workers=COMPARE_WORKERS) as executor:
+            identical_files = dict(
+                zip(common_paths, executor.map(compare_common_file, common_paths))
+            )
+
+        # Iterate through the source file tree
+        with tqdm(
+            total=len(folder_to_backup_tree),
+            file=sys.stderr,
+            unit="file",
+            desc="Processing files",
+            disable=not verbose,
+        ) as pbar:
+            # If the file does not exist in the destination file tree,
+            # simply move the file from the source to the destination.
+            for rel_path in new_paths:
+                # Construct the absolute file paths for the source and destination files
+                source_file_path = source_prefix + rel_path
+                dest_file_path = dest_prefix + rel_path
+
+                logger.info("Moving %s to %s", source_file_path, dest_file_path)
+                if not dry_run:
+                    # Create the destination folder if it doesn't exist
+                    dest_folder_path = os.path.dirname(dest_file_path)
+                    if dest_folder_path not in created_dirs:
+                        Path(dest_folder_path).mkdir(parents=True, exist_ok=True)
+                        created_dirs.add(dest_folder_path)
+
+                    # Copy the file from the source to the destination
+                    move_file(source_file_path, dest_file_path, same_device)
+                    moved_paths.append(rel_path)
+                    count_moved += 1
+                pbar.update(1)
+
+            # Resolve the files that exist in both locations
+            for rel_path in common_paths:
+                # Construct the absolute file paths for the source and destination files
+                source_file_path = source_prefix + rel_path
+                dest_file_path = dest_prefix + rel_path
+
+                # Get the modification time and size of the source file
+                source_mtime, source_size = folder_to_backup_tree[rel_path]
+
+                logger.info("Found file %s in backup location", rel_path)
+                # Get the modification time and size of the destination file
+                dest_mtime, dest_size = backup_location_tree[rel_path]
+
+                # If the content of the source and destination files is the
+                # same, delete the source file.
+                if identical_files[rel_path]:
+                    logger.info(" SAME, deleting %s", source_file_path)
                     if not dry_run:
                         os.remove(source_file_path)
                     count_different += 1
@@ -156,34 +1193,56 @@ def merge_backup(folder_to_backup, backup_location, verbose=False, dry_run=False
 
                     # Create the '.oldversion' subfolder if it doesn't exist
                     old_versions_dir = os.path.join(os.path.dirname(dest_file_path), ".oldversion")
-                    if not dry_run:
+                    if not dry_run and old_versions_dir not in created_dirs:
                         Path(old_versions_dir).mkdir(exist_ok=True)
+                        created_dirs.add(old_versions_dir)
+
+                    # Split the file name once for naming the old version
+                    base_name, extension = os.path.splitext(os.path.basename(rel_path))
+                    if compress_old_versions:
+                        extension += OLD_VERSION_COMPRESSED_SUFFIX
 
                     # If the source file is newer, move the destination file to
                     # '.oldversion' and copy the source file to the destination.
                     if source_mtime > dest_mtime:
-                        old_version_datetime = datetime.fromtimestamp(dest_mtime).strftime(
-                            "%Y%m%d_%H%M%S"
-                        )
-                        old_version_filename = f"{os.path.splitext(os.path.basename(rel_path))[0]}_{old_version_datetime}{os.path.splitext(os.path.basename(rel_path))[1]}"
+                        old_version_datetime = _fmt_ts(dest_mtime)
+                        old_version_filename = f"{base_name}_{old_version_datetime}{extension}"
                         old_version_path = os.path.join(old_versions_dir, old_version_filename)
 
                         # Check if the file is unique compared to all other versions in the .oldversion folder
-                        if is_unique_version(dest_file_path, old_versions_dir):
-                            logging.info(
-                                f" NEWER: {source_file_path} is newer than destination file {dest_file_path}"
+                        if is_unique_version(
+                            dest_file_path,
+                            old_versions_dir,
+                            update_index=not dry_run,
+                            index_cache=old_versions_indexes,
+                            digest_cache=digest_cache,
+                        ):
+                            logger.info(
+                                " NEWER: %s is newer than destination file %s",
+                                source_file_path,
+                                dest_file_path,
                             )
-                            logging.info(f"  Moving {dest_file_path} to {old_version_path}")
-                            logging.info(f"  Moving {source_file_path} to {dest_file_path}")
+                            logger.info("  Moving %s to %s", dest_file_path, old_version_path)
+                            logger.info("  Moving %s to %s", source_file_path, dest_file_path)
                             if not dry_run:
-                                shutil.move(dest_file_path, old_version_path)
-                                shutil.move(source_file_path, dest_file_path)
+                                store_old_version(
+                                    dest_file_path,
+                                    (dest_mtime, dest_size),
+                                    old_version_path,
+                                    compress_old_versions,
+                                    index_cache=old_versions_indexes,
+                                    digest_cache=digest_cache,
+                                )
+                                move_file(source_file_path, dest_file_path, same_device)
+                                moved_paths.append(rel_path)
                             count_newer += 1
                         else:
-                            logging.info(
-                                f" NOT UNIQUE: {dest_file_path} is identical to an existing version in {old_versions_dir}"
+                            logger.info(
+                                " NOT UNIQUE: %s is identical to an existing version in %s",
+                                dest_file_path,
+                                old_versions_dir,
                             )
-                            logging.info(f"  Deleting {source_file_path}")
+                            logger.info("  Deleting %s", source_file_path)
                             if not dry_run:
                                 os.remove(source_file_path)
                             count_deleted += 1
@@ -191,47 +1250,58 @@ def merge_backup(folder_to_backup, backup_location, verbose=False, dry_run=False
                     # If the destination file is newer, move the source file to
                     # '.oldversion'.
                     elif source_mtime < dest_mtime:
-                        old_version_datetime = datetime.fromtimestamp(source_mtime).strftime(
-                            "%Y%m%d_%H%M%S"
-                        )
-                        old_version_filename = f"{os.path.splitext(os.path.basename(rel_path))[0]}_{old_version_datetime}{os.path.splitext(os.path.basename(rel_path))[1]}"
+                        old_version_datetime = _fmt_ts(source_mtime)
+                        old_version_filename = f"{base_name}_{old_version_datetime}{extension}"
                         old_version_path = os.path.join(old_versions_dir, old_version_filename)
-                        logging.info(
-                            f" OLDER: {source_file_path} is older than destination file {dest_file_path}"
+                        logger.info(
+                            " OLDER: %s is older than destination file %s",
+                            source_file_path,
+                            dest_file_path,
                         )
-                        logging.info(f" Moving {source_file_path} to {old_version_path}")
+                        logger.info(" Moving %s to %s", source_file_path, old_version_path)
                         if not dry_run:
-                            shutil.move(source_file_path, old_version_path)
+                            store_old_version(
+                                source_file_path,
+                                (source_mtime, source_size),
+                                old_version_path,
+                                compress_old_versions,
+                                same_device,
+                                old_versions_indexes,
+                                digest_cache,
+                            )
                         count_moved += 1
-            # If the file does not exist in the destination file tree,
-            # simply move the file from the source to the destination.
-            else:
-                logging.info(f"Moving {source_file_path} to {dest_file_path}")
-                if not dry_run:
-                    # Create the destination folder if it doesn't exist
-                    dest_folder_path = os.path.dirname(dest_file_path)
-                    Path(dest_folder_path).mkdir(parents=True, exist_ok=True)
+                pbar.update(1)
 
-                    # Copy the file from the source to the destination
-                    shutil.move(source_file_path, dest_file_path)
-                    count_moved += 1
-        pbar.update(1)
+        if not dry_run:
+            for old_versions_dir, index in old_versions_indexes.items():
+                save_old_versions_index(old_versions_dir, index)
+            # Only the source files that were moved can be in the backup location,
+            # and the backup tree is saved last so that its entries take precedence
+            moved_tree = {rel_path: folder_to_backup_tree[rel_path] for rel_path in moved_paths}
+            save_merge_manifest(
+                backup_location,
+                [(folder_to_backup, moved_tree), (backup_location, backup_location_tree)],
+                digest_cache,
+            )
 
-    logging.info(
-        f"FINISHED comparing {len(folder_to_backup_tree.items())} files from {folder_to_backup} to {backup_location}"
-    )
-    logging.info(f"Newer files: {count_newer}")
-    logging.info(f"Different versions: {count_different}")
-    logging.info(f"Deleted files: {count_deleted}")
-    logging.info(f"Moved files: {count_moved}")
+        logger.info(
+            "FINISHED comparing %d files from %s to %s",
+            len(folder_to_backup_tree),
+            folder_to_backup,
+            backup_location,
+        )
+        logger.info("Newer files: %d", count_newer)
+        logger.info("Different versions: %d", count_different)
+        logger.info("Deleted files: %d", count_deleted)
+        logger.info("Moved files: %d", count_moved)
 
-    if not dry_run:
-        # Remove the folder_to_backup after successful merge
-        shutil.rmtree(folder_to_backup)
-        logging.info(f"Deleted {folder_to_backup}")
+        if not dry_run:
+            # Remove the folder_to_backup after successful merge
+            shutil.rmtree(folder_to_backup)
+            logger.info("Deleted %s", folder_to_backup)
 
-    logging.info(f"Time elapsed: {(time.process_time_ns() - start_time)/1e9:.5f}s")
-    logging.info("------------------------------------------------------------")
+        logger.info("Time elapsed: %.5fs", (time.process_time_ns() - start_time) / 1e9)
+        logger.info("------------------------------------------------------------")
 
 
 def create_test_file(path, content, modified_time=None):
@@ -40,8 +40,8 @@ def main():
     Main function to parse command line arguments, validate them, and call the merge_backup function.
 
     This script merges backups and moves older versions to .oldversion folders. It takes two required
-    positional arguments, folder_to_backup and backup_location, and two optional flags, --verbose and
-    --dry_run.
+    positional arguments, folder_to_backup and backup_location, and three optional flags, --verbose,
+    --dry_run and --compress.
 
     Example usage:
 
@@ -70,12 +70,24 @@ def main():
         action="store_true",
         help="Perform a dry run without actually copying files. Use this option to check the backup process without making changes to the file system.",
     )
+    parser.add_argument(
+        "-c",
+        "--compress",
+        action="store_true",
+        help="Compress the older versions moved to .oldversion folders with Zstandard. This requires the zstandard package, installed with the compress extra.",
+    )
 
     args = parser.parse_args()
 
     try:
         validate_arguments(args.folder_to_backup, args.backup_location)
-        merge_backup(args.folder_to_backup, args.backup_location, args.verbose, args.dry_run)
+        merge_backup(
+            args.folder_to_backup,
+            args.backup_location,
+            args.verbose,
+            args.dry_run,
+            compress_old_versions=args.compress,
+        )
     except ValueError as e:
         logging.error(e)
     except Exception as e:
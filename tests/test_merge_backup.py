@@ -1,11 +1,52 @@
+import errno
+import json
 import os
-from datetime import datetime
+import struct
+from datetime import datetime, timedelta
 from pathlib import Path
 
-from merge_backups.backend import create_test_files_and_folders, merge_backup
+import pytest
+
+from merge_backups import backend
+from merge_backups.backend import (
+    ATTR_CMN_MODTIME,
+    ATTR_CMN_NAME,
+    ATTR_CMN_OBJTYPE,
+    ATTR_CMN_RETURNED_ATTRS,
+    ATTR_FILE_DATALENGTH,
+    MERGE_LOG,
+    MERGE_MANIFEST,
+    VDIR,
+    OLD_VERSIONS_INDEX,
+    VREG,
+    _parse_attr_buffer,
+    build_file_tree,
+    create_test_file,
+    create_test_files_and_folders,
+    decompress_old_version,
+    fast_cmp,
+    file_digest,
+    is_unique_version,
+    load_merge_manifest,
+    load_old_versions_index,
+    move_file,
+    quick_differ,
+    merge_backup,
+    save_old_versions_index,
+)
 from pprint import pprint
 
 
+@pytest.fixture
+def merge_folders(tmp_path):
+    """The folder to back up and the backup location of a merge, created empty."""
+    folder_to_backup = tmp_path / "folder_to_backup"
+    backup_location = tmp_path / "backup_location"
+    folder_to_backup.mkdir()
+    backup_location.mkdir()
+    return folder_to_backup, backup_location
+
+
 def test_merge_backup():
     # Set up the folder structure and files
     current_time, one_day_ago, one_day_later = create_test_files_and_folders()
@@ -22,9 +63,13 @@ def test_merge_backup():
         os.path.join("subdir1", "file5.txt"),
         os.path.join("subdir1", "file6.txt"),
         os.path.join(".oldversion", f"file1_{one_day_ago.strftime('%Y%m%d_%H%M%S')}.txt"),
+        os.path.join(".oldversion", OLD_VERSIONS_INDEX),
         os.path.join(
             "subdir1", ".oldversion", f"file4_{current_time.strftime('%Y%m%d_%H%M%S')}.txt"
         ),
+        os.path.join("subdir1", ".oldversion", OLD_VERSIONS_INDEX),
+        MERGE_MANIFEST,
+        MERGE_LOG,
     }
 
     # Verify that the files in the backup_location match the expected files
@@ -43,5 +88,384 @@ def test_merge_backup():
     assert not os.path.exists("folder_to_backup"), "The folder_to_backup has not been deleted"
 
 
+def test_merge_manifest(merge_folders):
+    folder_to_backup, backup_location = merge_folders
+    current_time = datetime.now()
+    create_test_file(folder_to_backup / "file1.txt", "File1 content\n", current_time)
+    create_test_file(backup_location / "file1.txt", "File1 content\n", current_time)
+
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    # The digest of the compared file is saved for the next merge
+    with open(backup_location / MERGE_MANIFEST) as f:
+        manifest = json.load(f)["files"]
+    dest_file_path = str(backup_location / "file1.txt")
+    assert manifest["file1.txt"]["size"] == 14
+    assert manifest["file1.txt"]["digest"] == file_digest(dest_file_path)
+
+    # The manifest and a temporary manifest left behind are never merged as user files
+    create_test_file(backup_location / (MERGE_MANIFEST + ".tmp"), "{}")
+    assert set(build_file_tree(str(backup_location))) == {"file1.txt"}
+    (folder_to_backup / "sub").mkdir(parents=True)
+    create_test_file(folder_to_backup / "sub" / MERGE_MANIFEST, "{}")
+    assert set(build_file_tree(str(folder_to_backup))) == {os.path.join("sub", MERGE_MANIFEST)}
+
+    digest_cache = {}
+    load_merge_manifest(str(backup_location), digest_cache)
+    key = (dest_file_path, manifest["file1.txt"]["mtime"], 14)
+    assert digest_cache[key] == manifest["file1.txt"]["digest"]
+
+    # Digests computed with a different hash are not reused
+    with open(backup_location / MERGE_MANIFEST, "w") as f:
+        json.dump({"hash": "other", "files": manifest}, f)
+    assert load_merge_manifest(str(backup_location)) == {}
+
+
+def test_merge_backup_compress_old_versions(tmp_path, merge_folders):
+    pytest.importorskip("zstandard")
+    folder_to_backup, backup_location = merge_folders
+    current_time = datetime.now()
+    one_day_ago = current_time - timedelta(days=1)
+    create_test_file(folder_to_backup / "file1.txt", "File1 content\n", current_time)
+    create_test_file(backup_location / "file1.txt", "File1 older content\n", one_day_ago)
+
+    merge_backup(str(folder_to_backup), str(backup_location), compress_old_versions=True)
+
+    old_versions_dir = backup_location / ".oldversion"
+    old_version_filename = f"file1_{one_day_ago.strftime('%Y%m%d_%H%M%S')}.txt.zst"
+    assert (backup_location / "file1.txt").read_text() == "File1 content\n"
+    assert load_old_versions_index(str(old_versions_dir))[old_version_filename]["compressed"]
+
+    # The compressed old version is recognized as identical to its content
+    create_test_file(tmp_path / "file1.txt", "File1 older content\n")
+    assert not is_unique_version(str(tmp_path / "file1.txt"), str(old_versions_dir))
+
+    decompress_old_version(
+        str(old_versions_dir / old_version_filename), str(tmp_path / "restored.txt")
+    )
+    assert (tmp_path / "restored.txt").read_text() == "File1 older content\n"
+    assert os.stat(tmp_path / "restored.txt").st_mtime == one_day_ago.timestamp()
+
+
+def test_compressed_old_versions_index_rebuilt(tmp_path, merge_folders):
+    pytest.importorskip("zstandard")
+    folder_to_backup, backup_location = merge_folders
+    current_time = datetime.now()
+    one_day_ago = current_time - timedelta(days=1)
+    create_test_file(folder_to_backup / "file1.txt", "File1 content\n", current_time)
+    create_test_file(backup_location / "file1.txt", "File1 older content\n", one_day_ago)
+    merge_backup(str(folder_to_backup), str(backup_location), compress_old_versions=True)
+
+    old_versions_dir = backup_location / ".oldversion"
+    index_path = old_versions_dir / OLD_VERSIONS_INDEX
+    old_version_filename = f"file1_{one_day_ago.strftime('%Y%m%d_%H%M%S')}.txt.zst"
+    create_test_file(tmp_path / "file1.txt", "File1 older content\n")
+
+    # An index saved with a different hash only loses its digests
+    with open(index_path) as f:
+        saved_index = json.load(f)
+    with open(index_path, "w") as f:
+        json.dump(dict(saved_index, hash="other"), f)
+    record = load_old_versions_index(str(old_versions_dir))[old_version_filename]
+    assert record["compressed"] and record["content_size"] == 20 and record["digest"] is None
+    assert not is_unique_version(str(tmp_path / "file1.txt"), str(old_versions_dir))
+
+    # A deleted index is rebuilt, and the compressed old version is hashed by its content
+    index_path.unlink()
+    assert not is_unique_version(str(tmp_path / "file1.txt"), str(old_versions_dir))
+    record = load_old_versions_index(str(old_versions_dir))[old_version_filename]
+    assert record["compressed"] and record["content_size"] == 20
+    assert record["digest"] == file_digest(str(tmp_path / "file1.txt"))
+
+
+def test_merge_backup_old_versions_index_cache(merge_folders, monkeypatch):
+    folder_to_backup, backup_location = merge_folders
+    (folder_to_backup / "subdir1").mkdir()
+    (backup_location / "subdir1").mkdir()
+    current_time = datetime.now()
+    one_day_ago = current_time - timedelta(days=1)
+    file_names = ["file1.txt", "file2.txt", "file3.txt"]
+    for folder in ["", "subdir1"]:
+        for file_name in file_names:
+            rel_path = os.path.join(folder, file_name)
+            create_test_file(folder_to_backup / rel_path, f"New {rel_path}\n", current_time)
+            create_test_file(backup_location / rel_path, f"Old {rel_path}\n", one_day_ago)
+
+    loaded_dirs = []
+    load_index = backend.load_old_versions_index
+
+    def counting_load_index(old_versions_dir):
+        loaded_dirs.append(old_versions_dir)
+        return load_index(old_versions_dir)
+
+    monkeypatch.setattr(backend, "load_old_versions_index", counting_load_index)
+    merge_backup(str(folder_to_backup), str(backup_location))
+    monkeypatch.undo()
+
+    # Each .oldversion folder is loaded once, and its index saved at the end of the
+    # merge lists all the versions stored during the merge
+    old_versions_dirs = [
+        str(backup_location / ".oldversion"),
+        str(backup_location / "subdir1" / ".oldversion"),
+    ]
+    assert sorted(loaded_dirs) == old_versions_dirs
+    old_version_datetime = one_day_ago.strftime("%Y%m%d_%H%M%S")
+    for old_versions_dir in old_versions_dirs:
+        with open(os.path.join(old_versions_dir, OLD_VERSIONS_INDEX)) as f:
+            index = json.load(f)["files"]
+        assert set(index) == {
+            f"{os.path.splitext(file_name)[0]}_{old_version_datetime}.txt"
+            for file_name in file_names
+        }
+
+
+def test_merge_backup_repeated_in_process(merge_folders):
+    folder_to_backup, backup_location = merge_folders
+    current_time = datetime.now()
+    one_day_ago = current_time - timedelta(days=1)
+    content = "0123456789abcdef" * 1000
+    changed_content = content[:8000] + "X" + content[8001:]
+    create_test_file(backup_location / "file1.txt", content, one_day_ago)
+
+    create_test_file(folder_to_backup / "file1.txt", content, current_time)
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    # The folder is refilled at the same path with a file of the same modification
+    # time and size, which only differs in the middle
+    folder_to_backup.mkdir()
+    create_test_file(folder_to_backup / "file1.txt", changed_content, current_time)
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    assert (backup_location / "file1.txt").read_text() == changed_content
+
+
+def test_merge_manifest_same_mtime_and_size(merge_folders):
+    folder_to_backup, backup_location = merge_folders
+    current_time = datetime.now()
+    one_day_later = current_time + timedelta(days=1)
+    content = "0123456789abcdef" * 1000
+    changed_content = content[:8000] + "X" + content[8001:]
+    create_test_file(backup_location / "file1.txt", content, current_time)
+
+    # A file with the same modification time and size that only differs in the
+    # middle is hashed, but not moved to the backup location
+    create_test_file(folder_to_backup / "file1.txt", changed_content, current_time)
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    with open(backup_location / MERGE_MANIFEST) as f:
+        manifest = json.load(f)["files"]
+    assert manifest["file1.txt"]["digest"] == file_digest(str(backup_location / "file1.txt"))
+
+    # A newer version of that file is therefore not taken for the backed up file
+    folder_to_backup.mkdir()
+    create_test_file(folder_to_backup / "file1.txt", changed_content, one_day_later)
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    assert (backup_location / "file1.txt").read_text() == changed_content
+
+
+def test_merge_log(merge_folders):
+    folder_to_backup, backup_location = merge_folders
+    one_day_later = datetime.now() + timedelta(days=1)
+    create_test_file(folder_to_backup / "file1.txt", "File1 content\n")
+    merge_backup(str(folder_to_backup), str(backup_location), verbose=True)
+
+    # The log of an older backup location being merged is not merged as a user file
+    folder_to_backup.mkdir()
+    create_test_file(folder_to_backup / "file2.txt", "File2 content\n")
+    create_test_file(folder_to_backup / MERGE_LOG, "Older log\n", one_day_later)
+    merge_backup(str(folder_to_backup), str(backup_location), verbose=True)
+
+    # Both merges appended to the same log, and the logger is left without handlers
+    log = (backup_location / MERGE_LOG).read_text()
+    assert log.count("Starting backup merge") == 2
+    assert "Older log" not in log
+    assert not (backup_location / ".oldversion").exists()
+    assert backend.logger.handlers == []
+
+
+def test_build_file_tree(tmp_path):
+    (tmp_path / "subdir1" / "subdir2").mkdir(parents=True)
+    create_test_file(tmp_path / "file1.txt", "File1 content\n")
+    create_test_file(tmp_path / "subdir1" / "file2.txt", "File2 longer content\n")
+    create_test_file(tmp_path / "subdir1" / "subdir2" / "file3.txt", "")
+
+    file_tree = build_file_tree(str(tmp_path), max_workers=4)
+
+    assert {rel_path: size for rel_path, (_, size) in file_tree.items()} == {
+        "file1.txt": 14,
+        os.path.join("subdir1", "file2.txt"): 21,
+        os.path.join("subdir1", "subdir2", "file3.txt"): 0,
+    }
+    mtime = file_tree["file1.txt"][0]
+    assert mtime == os.stat(tmp_path / "file1.txt").st_mtime
+
+
+def test_merge_backup_of_backup_location(merge_folders):
+    folder_to_backup, backup_location = merge_folders
+    (folder_to_backup / ".oldversion").mkdir()
+    (backup_location / ".oldversion").mkdir()
+    one_day_ago = datetime.now() - timedelta(days=1)
+    create_test_file(folder_to_backup / "file1.txt", "File1 content\n")
+    create_test_file(folder_to_backup / ".oldversion" / "file1_20230101_000000.txt", "Old\n")
+    create_test_file(folder_to_backup / ".oldversion" / OLD_VERSIONS_INDEX, "{}", one_day_ago)
+    create_test_file(backup_location / ".oldversion" / OLD_VERSIONS_INDEX, "{ }")
+    create_test_file(backup_location / ".oldversion" / (OLD_VERSIONS_INDEX + ".tmp"), "{}")
+
+    # The indexes of the two locations are not merged as user files
+    assert build_file_tree(str(backup_location)) == {}
+    merge_backup(str(folder_to_backup), str(backup_location))
+
+    backup_location_files = {
+        str(path.relative_to(backup_location))
+        for path in backup_location.rglob("*")
+        if path.is_file()
+    }
+    assert backup_location_files == {
+        "file1.txt",
+        os.path.join(".oldversion", "file1_20230101_000000.txt"),
+        os.path.join(".oldversion", OLD_VERSIONS_INDEX),
+        os.path.join(".oldversion", OLD_VERSIONS_INDEX + ".tmp"),
+        MERGE_MANIFEST,
+        MERGE_LOG,
+    }
+
+
+def test_parse_attr_buffer():
+    common = ATTR_CMN_RETURNED_ATTRS | ATTR_CMN_NAME | ATTR_CMN_OBJTYPE | ATTR_CMN_MODTIME
+
+    def pack_entry(name, objtype, tv_sec, tv_nsec, size=None):
+        fileattr = ATTR_FILE_DATALENGTH if size is not None else 0
+        name_bytes = name.encode() + b"\0"
+        fixed_length = 4 + 20 + 8 + 4 + 16 + (8 if size is not None else 0)
+        entry = struct.pack("=I5I", 0, common, 0, 0, fileattr, 0)
+        # The name offset is relative to the attrreference, which starts at byte 24
+        entry += struct.pack("=iI", fixed_length - 24, len(name_bytes))
+        entry += struct.pack("=Iqq", objtype, tv_sec, tv_nsec)
+        if size is not None:
+            entry += struct.pack("=q", size)
+        entry += name_bytes
+        entry += b"\0" * (-len(entry) % 8)
+        return struct.pack("=I", len(entry)) + entry[4:]
+
+    buffer = pack_entry("file1.txt", VREG, 1680000000, 500000000, 14)
+    buffer += pack_entry("subdir1", VDIR, 1680000001, 0)
+
+    assert _parse_attr_buffer(buffer, 2) == [
+        ("file1.txt", VREG, 1680000000 + 500000000 * 1e-9, 14),
+        ("subdir1", VDIR, 1680000001.0, None),
+    ]
+
+
+def test_fast_cmp(tmp_path):
+    content = "0123456789abcdef" * 100000
+    create_test_file(tmp_path / "large1.txt", content)
+    create_test_file(tmp_path / "large2.txt", content)
+    create_test_file(tmp_path / "large3.txt", content[:-1] + "X")
+    create_test_file(tmp_path / "small.txt", "Small content\n")
+    create_test_file(tmp_path / "empty1.txt", "")
+    create_test_file(tmp_path / "empty2.txt", "")
+
+    assert fast_cmp(str(tmp_path / "large1.txt"), str(tmp_path / "large2.txt"))
+    assert not fast_cmp(str(tmp_path / "large1.txt"), str(tmp_path / "large3.txt"))
+    assert not fast_cmp(str(tmp_path / "large1.txt"), str(tmp_path / "small.txt"))
+    assert fast_cmp(str(tmp_path / "empty1.txt"), str(tmp_path / "empty2.txt"))
+
+
+def test_quick_differ(tmp_path):
+    content = "0123456789abcdef" * 1000
+    create_test_file(tmp_path / "file1.txt", content)
+    create_test_file(tmp_path / "head.txt", "X" + content[1:])
+    create_test_file(tmp_path / "middle.txt", content[:8000] + "X" + content[8001:])
+    create_test_file(tmp_path / "tail.txt", content[:-1] + "X")
+
+    size = len(content)
+    assert quick_differ(str(tmp_path / "file1.txt"), str(tmp_path / "head.txt"), size)
+    assert quick_differ(str(tmp_path / "file1.txt"), str(tmp_path / "tail.txt"), size)
+    # Differences outside the first and last block need a full comparison
+    assert not quick_differ(str(tmp_path / "file1.txt"), str(tmp_path / "middle.txt"), size)
+
+
+def test_move_file_rename(tmp_path, monkeypatch):
+    one_day_ago = datetime.now() - timedelta(days=1)
+    create_test_file(tmp_path / "file1.txt", "File1 content\n", one_day_ago)
+    create_test_file(tmp_path / "file2.txt", "File2 content\n", one_day_ago)
+
+    move_file(str(tmp_path / "file1.txt"), str(tmp_path / "moved1.txt"))
+
+    assert not (tmp_path / "file1.txt").exists()
+    assert (tmp_path / "moved1.txt").read_text() == "File1 content\n"
+
+    # A rename that fails, as it does across file systems, falls back to a copy
+    def rename_across_devices(source_path, dest_path):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), source_path)
+
+    monkeypatch.setattr(os, "rename", rename_across_devices)
+    move_file(str(tmp_path / "file2.txt"), str(tmp_path / "moved2.txt"))
+
+    assert not (tmp_path / "file2.txt").exists()
+    assert (tmp_path / "moved2.txt").read_text() == "File2 content\n"
+    assert os.stat(tmp_path / "moved2.txt").st_mtime == one_day_ago.timestamp()
+
+
+def test_move_file_across_devices(tmp_path):
+    one_day_ago = datetime.now() - timedelta(days=1)
+    create_test_file(tmp_path / "file1.txt", "File1 content\n" * 1000, one_day_ago)
+
+    # Copying instead of renaming keeps the content and modification time
+    move_file(str(tmp_path / "file1.txt"), str(tmp_path / "moved.txt"), same_device=False)
+
+    assert not (tmp_path / "file1.txt").exists()
+    assert (tmp_path / "moved.txt").read_text() == "File1 content\n" * 1000
+    assert os.stat(tmp_path / "moved.txt").st_mtime == one_day_ago.timestamp()
+
+
+def test_move_file_incomplete_copy(tmp_path, monkeypatch):
+    content = "File1 content\n" * 1000
+    create_test_file(tmp_path / "file1.txt", content)
+
+    # copy_file_range stopping early falls back to shutil.copyfile
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    move_file(str(tmp_path / "file1.txt"), str(tmp_path / "moved.txt"), same_device=False)
+    assert (tmp_path / "moved.txt").read_text() == content
+
+    # A copy that is still incomplete does not remove the original file
+    create_test_file(tmp_path / "file2.txt", content)
+    monkeypatch.setattr(
+        backend.shutil, "copyfile", lambda source, dest: Path(dest).write_text(content[:100])
+    )
+    with pytest.raises(OSError):
+        move_file(str(tmp_path / "file2.txt"), str(tmp_path / "moved2.txt"), same_device=False)
+    assert (tmp_path / "file2.txt").read_text() == content
+
+
+def test_is_unique_version(tmp_path):
+    old_versions_dir = tmp_path / ".oldversion"
+    old_versions_dir.mkdir()
+    create_test_file(old_versions_dir / "file_20230101_000000.txt", "Old content\n")
+    create_test_file(old_versions_dir / "file_20230102_000000.txt", "Longer old content\n")
+
+    create_test_file(tmp_path / "same.txt", "Old content\n")
+    create_test_file(tmp_path / "same_size.txt", "New content\n")
+    create_test_file(tmp_path / "other_size.txt", "Other content\n")
+
+    assert not is_unique_version(str(tmp_path / "same.txt"), str(old_versions_dir))
+    assert is_unique_version(str(tmp_path / "same_size.txt"), str(old_versions_dir))
+    assert is_unique_version(str(tmp_path / "other_size.txt"), str(old_versions_dir))
+
+    # Only the old version with a matching size has been hashed and indexed, and a temporary
+    # index left behind by an interrupted write is not taken for an old version
+    create_test_file(old_versions_dir / (OLD_VERSIONS_INDEX + ".tmp"), "Old content\n")
+    index = load_old_versions_index(str(old_versions_dir))
+    assert set(index) == {"file_20230101_000000.txt", "file_20230102_000000.txt"}
+    assert index["file_20230101_000000.txt"]["digest"] is not None
+    assert index["file_20230102_000000.txt"]["digest"] is None
+
+    # Records without a digest are rebuilt instead of failing the check
+    del index["file_20230101_000000.txt"]["digest"]
+    save_old_versions_index(str(old_versions_dir), index)
+    assert not is_unique_version(str(tmp_path / "same.txt"), str(old_versions_dir))
+
+
 if __name__ == "__main__":
     test_merge_backup()